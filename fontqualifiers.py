@@ -25,9 +25,57 @@ Usage details:
 
 import re
 
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2 has no functools.lru_cache, so provide a simple bounded memo. There is
+    # no eviction ordering; the whole cache is dropped when it fills, which is crude
+    # but keeps the memory use bounded when arbitrary font strings are parsed.
+    def lru_cache(maxsize=None):
+        def decorator(func):
+            cache = {}
+            def wrapper(*args):
+                try:
+                    return cache[args]
+                except KeyError:
+                    result = func(*args)
+                    if maxsize is not None and len(cache) >= maxsize:
+                        cache.clear()
+                    cache[args] = result
+                    return result
+            wrapper.cache_clear = cache.clear
+            return wrapper
+        return decorator
+
+
+def _is_valid_identifier(s):
+    """
+    Check that an identifier only uses the characters acceptable in a font string.
+
+    Identifiers may use any of the printable ASCII characters, excluding the space
+    (ie \x21-\x7e). Characters outside that range compare outside the '!'-'~' range,
+    so two C-level scans of the string are sufficient (and much cheaper than
+    invoking the regex engine for such a trivial character class).
+    """
+    return bool(s) and min(s) >= '!' and max(s) <= '~'
+
 
-# Identifiers which can be used in the string
-acceptable_identifiers_re = re.compile(r'^[\x21-\x7e]+$')
+# A single qualifier and its value; the value runs to the next '\' or the end of
+# the string. finditer with this pattern tokenises a whole font string in one pass
+# of the regex engine.
+_TOKEN_RE = re.compile(r'\\([FfEeM])([^\\]*)')
+
+# The entire value of a matrix qualifier: 6 decimal integers separated by single
+# spaces, optionally preceded by spaces and followed by at most one trailing space.
+# Matching this once replaces the lstrip/split/pop/count sequence with a single
+# pass of the regex engine. \Z anchors at the true end of the value; '$' would
+# also match before a trailing newline, silently accepting one.
+_MATRIX_RE = re.compile(r'^ *(-?\d+) (-?\d+) (-?\d+) (-?\d+) (-?\d+) (-?\d+)( ?)\Z')
+
+# The limits of the values acceptable within a matrix, which must fit in a signed
+# 32bit word (with both extremes excluded, as they always have been).
+_MATRIX_MIN = -(1 << 31) + 1
+_MATRIX_MAX = (1 << 31) - 1
 
 
 class FontQualifiersError(Exception):
@@ -44,11 +92,218 @@ class FontQualifiersBadMatrixError(FontQualifiersError):
     pass
 
 
-class FontQualifierEmpty(object):
+class _FontQualifierEmptyType(object):
     """
     A placeholder for an empty field in a font qualifier.
     """
-    pass
+    __slots__ = ()
+
+    def __repr__(self):
+        return '<empty>'
+
+
+# The placeholder is a singleton, only ever compared with 'is'; the public name is
+# bound to the instance so that existing 'value is FontQualifierEmpty' checks hold.
+FontQualifierEmpty = _FontQualifierEmptyType()
+
+
+def _parse_qualifier_F(part, allow_empty, need_trailing_space_on_matrix):
+    """
+    Parse the value of a 'F' (font name) qualifier.
+    """
+    if part == '' and allow_empty:
+        return FontQualifierEmpty
+    if not _is_valid_identifier(part):
+        raise FontQualifiersBadStringError("Invalid font name in '%s'" % (part,))
+    return part
+
+
+def _parse_qualifier_f(part, allow_empty, need_trailing_space_on_matrix):
+    """
+    Parse the value of a 'f' (local font name) qualifier into (territory, name).
+    """
+    if part == '' and allow_empty:
+        return FontQualifierEmpty
+    (territory, sep, name) = part.partition(' ')
+    if not sep:
+        raise FontQualifiersBadStringError("Cannot parse font name qualifier in '%s'" % (part,))
+    try:
+        territory = int(territory)
+    except ValueError:
+        raise FontQualifiersBadStringError("Cannot parse font name qualifier with invalid territory in '%s'" % (part,))
+    return (territory, name)
+
+
+def _parse_qualifier_E(part, allow_empty, need_trailing_space_on_matrix):
+    """
+    Parse the value of a 'E' (encoding name) qualifier.
+    """
+    if part == '' and allow_empty:
+        return FontQualifierEmpty
+    if not _is_valid_identifier(part):
+        raise FontQualifiersBadStringError("Invalid encoding name qualifier in '%s'" % (part,))
+    return part
+
+
+def _parse_qualifier_e(part, allow_empty, need_trailing_space_on_matrix):
+    """
+    Parse the value of a 'e' (local encoding name) qualifier into (territory, name).
+    """
+    if part == '' and allow_empty:
+        return FontQualifierEmpty
+    (territory, sep, name) = part.partition(' ')
+    if not sep:
+        raise FontQualifiersBadStringError("Cannot parse font encoding qualifier in '%s'" % (part,))
+    try:
+        territory = int(territory)
+    except ValueError:
+        raise FontQualifiersBadStringError("Cannot parse font encoding qualifier with invalid territory in '%s'" % (part,))
+    return (territory, name)
+
+
+def _parse_qualifier_M(part, allow_empty, need_trailing_space_on_matrix):
+    """
+    Parse the value of a 'M' (matrix) qualifier into a tuple of 6 values.
+    """
+    if part == '' and allow_empty:
+        return FontQualifierEmpty
+
+    # This is a matrix request.
+    # These have the form of 6 decimal integers separated by a space (and with a trailing space)
+    # The PRM states 'Each number - including the last one - must be followed by a space.'.
+    # This is NOT true; the final character of the qualifier need not be a space.
+    # So we allow this to be parsed as acceptable.
+    match = _MATRIX_RE.match(part)
+    if match is None:
+        # Error path only: split the value up as the parser previously did, so that the
+        # diagnostics are unchanged. Splitting on single spaces means that runs of
+        # spaces count as extra (empty) components rather than being collapsed.
+        matrix_parts = part.lstrip(' ').split(' ')
+        if matrix_parts and matrix_parts[-1] == '':
+            # IF there's a trailing space, trim it.
+            matrix_parts.pop()
+        elif need_trailing_space_on_matrix:
+            raise FontQualifiersBadMatrixError("Cannot parse font matrix without trailing space in '%s'" % (part))
+        if len(matrix_parts) != 6:
+            raise FontQualifiersBadMatrixError("Cannot parse font matrix with %i components in '%s'" % (len(matrix_parts), part))
+        raise FontQualifiersBadMatrixError("Cannot parse font matrix values as integers in '%s'" % (part))
+
+    if need_trailing_space_on_matrix and not match.group(7):
+        raise FontQualifiersBadMatrixError("Cannot parse font matrix without trailing space in '%s'" % (part))
+
+    # FIXME: Check whether this should actually be a value from OS_ReadUnsigned? ie 16_10000 is valid?
+    # The regex has already guaranteed that every group is a decimal integer, so the
+    # conversions cannot fail; map() batches them without per-iteration bytecode.
+    values = tuple(map(int, match.groups()[:6]))
+    for value in values:
+        if not _MATRIX_MIN <= value <= _MATRIX_MAX:
+            raise FontQualifiersBadMatrixError("Cannot value too large in font matrix '%s'" % (part,))
+    # The first 4 values are 16.16 scale factors; the last 2 are offsets in
+    # 1000s of an em. Unrolled, as this is always exactly 6 values.
+    (a, b, c, d, e, f) = values
+    return (a / 65536.0, b / 65536.0, c / 65536.0, d / 65536.0,
+            e / 1000.0, f / 1000.0)
+
+
+# Dispatch table mapping each qualifier character to the index of the field that it
+# populates within the parsed fields tuple, and the handler which parses its value.
+# A single dict lookup replaces a chain of character comparisons per qualifier.
+_QUALIFIER_HANDLERS = {
+        'F': (0, _parse_qualifier_F),
+        'f': (1, _parse_qualifier_f),
+        'E': (2, _parse_qualifier_E),
+        'e': (3, _parse_qualifier_e),
+        'M': (4, _parse_qualifier_M),
+    }
+
+
+def _parse_fields(font_string, need_trailing_space_on_matrix, allow_empty):
+    """
+    Parse a font string into its constituent fields.
+
+    @param font_string: The font string to parse
+    @param need_trailing_space_on_matrix: Whether the trailing space on the matrix is required
+    @param allow_empty: Allow a field to be supplied with an empty string
+
+    @return: tuple of (fontid, fontlocal, encoding, encodinglocal, matrix), with the
+             matrix as a tuple of 6 values so that the result is immutable
+    """
+    fields = [None, None, None, None, None]
+
+    if font_string == '':
+        if allow_empty:
+            # This means that there are no fields to apply, so we can return with nothing set
+            return tuple(fields)
+        raise FontQualifiersBadStringError("Invalid font name in ''")
+
+    n = len(font_string)
+    i = 0
+    if font_string[0] != '\\':
+        # A bare font name, possibly followed by qualifiers. Treat the leading run as
+        # an implicit 'F' qualifier, rather than parsing a '\F'-prefixed copy of the
+        # whole string.
+        i = font_string.find('\\')
+        if i == -1:
+            i = n
+        fields[0] = _parse_qualifier_F(font_string[:i], allow_empty,
+                                       need_trailing_space_on_matrix)
+
+    # Tokenise the remaining qualifiers in a single pass of the regex engine; each
+    # match is one '\<qualifier><value>' pair. Any gap between consecutive matches
+    # means an unrecognised qualifier, which is diagnosed after the loop.
+    pos = i
+    for match in _TOKEN_RE.finditer(font_string, i):
+        if match.start() != pos:
+            break
+        handler = _QUALIFIER_HANDLERS[match.group(1)]
+        fields[handler[0]] = handler[1](match.group(2), allow_empty,
+                                        need_trailing_space_on_matrix)
+        pos = match.end()
+
+    if pos != n:
+        # font_string[pos] is the '\' of the qualifier which failed to match.
+        if pos + 1 < n:
+            raise FontQualifiersBadStringError("Cannot parse qualifier '%s'" % (font_string[pos + 1],))
+        raise FontQualifiersBadStringError("Cannot parse qualifier ''")
+
+    return tuple(fields)
+
+
+def _merge_field(current_value, new_value):
+    """
+    Merge a field from a second font string on to a current value.
+
+    If a new empty field was given, the value is unset; if a new value was given, use it,
+    otherwise use the original value.
+    """
+    if new_value is FontQualifierEmpty:
+        return None
+    if new_value is not None:
+        return new_value
+    return current_value
+
+
+@lru_cache(maxsize=1024)
+def _parse_cached(font_string, need_trailing_space_on_matrix, allow_empty):
+    """
+    Parse a font string, memoising the result.
+
+    Real usage repeatedly parses the same small set of font strings (documents
+    reference only a few fonts), so the parsed fields are cached against the
+    font string. Parse failures are cached as well, so that repeatedly supplied
+    bad strings do not re-run the parser.
+
+    @return: tuple of (error, fields); error is the exception raised by the parse
+             (or None), and fields is the tuple from L{_parse_fields} (or None)
+    """
+    try:
+        return (None, _parse_fields(font_string, need_trailing_space_on_matrix, allow_empty))
+    except FontQualifiersError as exc:
+        # Drop the traceback from the cached exception, so that the cache does not pin
+        # the raising frames in memory (Python 2 exceptions carry no traceback).
+        if hasattr(exc, '__traceback__'):
+            exc.__traceback__ = None
+        return (exc, None)
 
 
 class FontQualifiers(object):
@@ -65,6 +320,7 @@ class FontQualifiers(object):
                         converted from the standard 16.16 matrix values for the scaling factors,
                         and in 1000s of an em for the offsets.
     """
+    __slots__ = ('fontid', 'fontlocal', 'encoding', 'encodinglocal', 'matrix')
 
     def __init__(self, font_string, need_trailing_space_on_matrix=False, allow_empty=False):
         """
@@ -84,20 +340,19 @@ class FontQualifiers(object):
         self.parse(font_string, need_trailing_space_on_matrix, allow_empty)
 
     def __repr__(self):
-        parts = [('fontid', self.fontid),
-                 ('fontlocal', self.fontlocal),
-                 ('encoding', self.encoding),
-                 ('encodinglocal', self.encodinglocal),
-                 ('matrix', self.matrix)]
-        parts = [part for part in parts if part[1] is not None]
-        def value(p):
-            if p is FontQualifierEmpty:
-                return '<empty>'
+        items = []
+        for name, value in (('fontid', self.fontid),
+                            ('fontlocal', self.fontlocal),
+                            ('encoding', self.encoding),
+                            ('encodinglocal', self.encodinglocal),
+                            ('matrix', self.matrix)):
+            if value is None:
+                continue
+            if value is FontQualifierEmpty:
+                items.append(name + '=<empty>')
             else:
-                return repr(p)
-        parts = ["{}={}".format(part[0], value(part[1])) for part in parts]
-        return "<{}({})>".format(self.__class__.__name__,
-                                 ', '.join(parts))
+                items.append('%s=%r' % (name, value))
+        return "<%s(%s)>" % (self.__class__.__name__, ', '.join(items))
 
     def __str__(self):
         return self.font_string
@@ -107,128 +362,84 @@ class FontQualifiers(object):
         """
         Create a font string from the properties.
         """
-        fields = []
-        if self.fontid is not None and self.fontid is not FontQualifierEmpty:
-            fields.append(('F', self.fontid))
-        if self.fontlocal is not None and self.fontlocal is not FontQualifierEmpty:
-            fields.append(('f', '{} {}'.format(self.fontlocal[0], self.fontlocal[1])))
-
-        if self.encoding is not None and self.encoding is not FontQualifierEmpty:
-            fields.append(('E', self.encoding))
-        if self.encodinglocal is not None and self.encodinglocal is not FontQualifierEmpty:
-            fields.append(('e', '{} {}'.format(self.encodinglocal[0], self.encodinglocal[1])))
-
-        if self.matrix is not None and self.matrix is not FontQualifierEmpty:
+        # Bind the sentinel and each field to locals, so that the presence checks are
+        # pairs of fast 'is' tests without repeated attribute lookups.
+        empty = FontQualifierEmpty
+        parts = []
+        fontid = self.fontid
+        if fontid is not None and fontid is not empty:
+            parts.append('\\F' + fontid)
+        fontlocal = self.fontlocal
+        if fontlocal is not None and fontlocal is not empty:
+            parts.append('\\f{} {}'.format(fontlocal[0], fontlocal[1]))
+
+        encoding = self.encoding
+        if encoding is not None and encoding is not empty:
+            parts.append('\\E' + encoding)
+        encodinglocal = self.encodinglocal
+        if encodinglocal is not None and encodinglocal is not empty:
+            parts.append('\\e{} {}'.format(encodinglocal[0], encodinglocal[1]))
+
+        matrix = self.matrix
+        if matrix is not None and matrix is not empty:
             # We always include the trailing space when generating the string as this string
             # may need to be stored in a document that is used on a system which conforms to
             # the PRM.
-            fields.append(('M', '{} {} {} {} {} {} '.format(int(self.matrix[0] * 65536),
-                                                            int(self.matrix[1] * 65536),
-                                                            int(self.matrix[2] * 65536),
-                                                            int(self.matrix[3] * 65536),
-                                                            int(self.matrix[4] * 1000),
-                                                            int(self.matrix[5] * 1000))))
-
-        if len(fields) == 1 and fields[0][0] == 'F':
+            parts.append('\\M%d %d %d %d %d %d ' % (int(matrix[0] * 65536),
+                                                    int(matrix[1] * 65536),
+                                                    int(matrix[2] * 65536),
+                                                    int(matrix[3] * 65536),
+                                                    int(matrix[4] * 1000),
+                                                    int(matrix[5] * 1000)))
+
+        if len(parts) == 1 and parts[0].startswith('\\F'):
             # There is only the font name, so we may as well return it as a bare font name;
             # there's no point in returning it with the qualifier prepended
-            return fields[0][1]
+            return parts[0][2:]
 
-        parts = ['\\{}{}'.format(field[0], field[1]) for field in fields]
         return ''.join(parts)
 
-    def parse(self, font_string, need_trailing_space_on_matrix=False, allow_empty=False):
-        font_string = font_string or ''
+    @classmethod
+    def parsed_fields(cls, font_string, need_trailing_space_on_matrix=False, allow_empty=False):
+        """
+        Parse a font string into its fields, without constructing an instance.
 
-        if font_string == '' and allow_empty:
-            # This means that there are no fields to apply, so we can return with nothing set
-            return
-
-        if font_string == '' or font_string[0] != '\\':
-            font_string = '\\F' + font_string
-
-        parts = font_string.split('\\')
-        # The first part will be empty
-
-        for part in parts[1:]:
-            qualifier = part[0]
-            part = part[1:]
-            if qualifier == 'F':
-                if part == '' and allow_empty:
-                    self.fontid = FontQualifierEmpty
-                else:
-                    self.fontid = part
-                    if not acceptable_identifiers_re.search(part):
-                        raise FontQualifiersBadStringError("Invalid font name in '%s'" % (part,))
-
-            elif qualifier == 'f':
-                if part == '' and allow_empty:
-                    self.fontlocal = FontQualifierEmpty
-                else:
-                    if ' ' not in part:
-                        raise FontQualifiersBadStringError("Cannot parse font name qualifier in '%s'" % (part,))
-                    (territory, name) = part.split(' ', 1)
-                    try:
-                        territory = int(territory)
-                    except ValueError:
-                        raise FontQualifiersBadStringError("Cannot parse font name qualifier with invalid territory in '%s'" % (part,))
-                    self.fontlocal = (territory, name)
-
-            elif qualifier == 'E':
-                if part == '' and allow_empty:
-                    self.encoding = FontQualifierEmpty
-                else:
-                    self.encoding = part
-                    if not acceptable_identifiers_re.search(part):
-                        raise FontQualifiersBadStringError("Invalid encoding name qualifier in '%s'" % (part,))
-
-            elif qualifier == 'e':
-                if part == '' and allow_empty:
-                    self.encodinglocal = FontQualifierEmpty
-                else:
-                    if ' ' not in part:
-                        raise FontQualifiersBadStringError("Cannot parse font encoding qualifier in '%s'" % (part,))
-                    (territory, name) = part.split(' ', 1)
-                    try:
-                        territory = int(territory)
-                    except ValueError:
-                        raise FontQualifiersBadStringError("Cannot parse font encoding qualifier with invalid territory in '%s'" % (part,))
-                    self.encodinglocal = (territory, name)
-
-            elif qualifier == 'M':
-                if part == '' and allow_empty:
-                    self.matrix = FontQualifierEmpty
-                else:
-                    # This is a matrix request.
-                    # These have the form of 6 decimal integers separated by a space (and with a trailing space)
-                    # The PRM states 'Each number - including the last one - must be followed by a space.'.
-                    # This is NOT true; the final character of the qualifier need not be a space.
-                    # So we allow this to be parsed as acceptable.
-                    part = part.lstrip(' ')
-                    matrix_parts = part.split(' ')
-                    if matrix_parts and matrix_parts[-1] == '':
-                        # IF there's a trailing space, trim it.
-                        matrix_parts.pop()
-                    else:
-                        if need_trailing_space_on_matrix:
-                            raise FontQualifiersBadMatrixError("Cannot parse font matrix without trailing space in '%s'" % (part))
-
-                    if len(matrix_parts) != 6:
-                        raise FontQualifiersBadMatrixError("Cannot parse font matrix with %i components in '%s'" % (len(matrix_parts), part))
-                    try:
-                        # FIXME: Check whether this should actually be a value from OS_ReadUnsigned? ie 16_10000 is valid?
-                        values = [int(value) for value in matrix_parts]
-                        if any((value >= (1<<31) for value in values)):
-                            raise FontQualifiersBadMatrixError("Cannot value too large in font matrix '%s'" % (part,))
-                        if any((value <= -(1<<31) for value in values)):
-                            raise FontQualifiersBadMatrixError("Cannot value too large in font matrix '%s'" % (part,))
-                        matrix = [value / 65536.0 if index < 4 else value / 1000.0 for index, value in enumerate(values)]
-                    except ValueError:
-                        raise FontQualifiersBadMatrixError("Cannot parse font matrix values as integers in '%s'" % (part))
-                    self.matrix = matrix
+        @param font_string: The font string to parse
+        @param need_trailing_space_on_matrix: Whether the trailing space on the matrix is required
+        @param allow_empty: Allow a field to be supplied with an empty string
 
-            else:
-                raise FontQualifiersBadStringError("Cannot parse qualifier '%s'" % (qualifier,))
+        @return: tuple of (fontid, fontlocal, encoding, encodinglocal, matrix), with the
+                 matrix as an immutable tuple of 6 values
+        """
+        (error, fields) = _parse_cached(font_string or '',
+                                        need_trailing_space_on_matrix,
+                                        allow_empty)
+        if error is not None:
+            # Re-raise a fresh copy of the cached exception, so that tracebacks
+            # are not accumulated on the cached object.
+            raise error.__class__(*error.args)
+        return fields
+
+    def parse(self, font_string, need_trailing_space_on_matrix=False, allow_empty=False):
+        (fontid, fontlocal, encoding,
+         encodinglocal, matrix) = self.parsed_fields(font_string,
+                                                     need_trailing_space_on_matrix,
+                                                     allow_empty)
+
+        # Only the fields present in the string are assigned, so that parsing into an
+        # existing instance merges with its current state.
+        if fontid is not None:
+            self.fontid = fontid
+        if fontlocal is not None:
+            self.fontlocal = fontlocal
+        if encoding is not None:
+            self.encoding = encoding
+        if encodinglocal is not None:
+            self.encodinglocal = encodinglocal
+        if matrix is not None:
+            # The matrix is cached as an immutable tuple; each instance gets its own
+            # list so that callers may modify it safely.
+            self.matrix = matrix if matrix is FontQualifierEmpty else list(matrix)
 
     def apply_fields(self, font_string, need_trailing_space_on_matrix=False):
         """
@@ -238,25 +449,21 @@ class FontQualifiers(object):
         remove the field. The classic FontManager operates on these strings as bare elements,
         whereas we will process the strings into their constituents every time.
         """
-        apply = FontQualifiers(font_string,
-                               need_trailing_space_on_matrix=need_trailing_space_on_matrix,
-                               allow_empty=True)
-
-        def reduce(current_value, new_value):
-            """
-            If new empty field was given, the value is unset; if new value given, use it, otherwise use original.
-            """
-            if new_value is FontQualifierEmpty:
-                return None
-            if new_value is not None:
-                return new_value
-            return current_value
-
-        self.fontid = reduce(self.fontid, apply.fontid)
-        self.fontlocal = reduce(self.fontlocal, apply.fontlocal)
-        self.encoding = reduce(self.encoding, apply.encoding)
-        self.encodinglocal = reduce(self.encodinglocal, apply.encodinglocal)
-        self.matrix = reduce(self.matrix, apply.matrix)
+        (fontid, fontlocal, encoding, encodinglocal, matrix) = \
+                self.parsed_fields(font_string,
+                                   need_trailing_space_on_matrix=need_trailing_space_on_matrix,
+                                   allow_empty=True)
+
+        self.fontid = _merge_field(self.fontid, fontid)
+        self.fontlocal = _merge_field(self.fontlocal, fontlocal)
+        self.encoding = _merge_field(self.encoding, encoding)
+        self.encodinglocal = _merge_field(self.encodinglocal, encodinglocal)
+        # The cached matrix is a tuple; a copy is taken as a list, matching the form
+        # that parsing gives the instance.
+        if matrix is FontQualifierEmpty:
+            self.matrix = None
+        elif matrix is not None:
+            self.matrix = list(matrix)
 
     @staticmethod
     def find_field(font_string, wanted):
@@ -270,17 +477,13 @@ class FontQualifiers(object):
         if not font_string:
             return None
 
-        offset = 0
         if font_string[0] != '\\' and wanted == 'F':
             return 0
 
-        parts = font_string.split('\\')
-        offset = len(parts[0])
-        for part in parts[1:]:
-            offset += 2
-            qualifier = part[0]
-            if qualifier == wanted:
-                return offset
-            offset += len(part) - 1
-
-        return None
+        # Any '\' in a font string introduces a qualifier (values can never contain a
+        # backslash), so searching for the qualifier pair directly locates the field in
+        # a single fast substring search, and a miss costs no more than that search.
+        i = font_string.find('\\' + wanted)
+        if i == -1:
+            return None
+        return i + 2
@@ -118,6 +118,10 @@ class Test40Matrix(FQTestCase):
         with self.assertRaises(fontqualifiers.FontQualifiersBadMatrixError):
             fq = fontqualifiers.FontQualifiers(r'\M0 0 0 0 0 0 0')
 
+    def test_18_trailing_newline(self):
+        with self.assertRaises(fontqualifiers.FontQualifiersBadMatrixError):
+            fq = fontqualifiers.FontQualifiers('\\M0 0 0 0 0 0 \n')
+
     def test_20_negative(self):
         fq = fontqualifiers.FontQualifiers(r'\M-65536 0 0 -65536 0 -1')
 
@@ -134,6 +138,23 @@ class Test40Matrix(FQTestCase):
         self.assertEqual(fq.matrix, [0.5, 0.25, 2, 1.5, 1, 0.5])
 
 
+class Test45Reparse(FQTestCase):
+
+    def test_01_reparse_keeps_other_fields(self):
+        fq = fontqualifiers.FontQualifiers(r'\FHomerton.Medium')
+        fq.parse(r'\ELatin1')
+
+        self.assertEqual(fq.fontid, 'Homerton.Medium')
+        self.assertEqual(fq.encoding, 'Latin1')
+
+    def test_02_reparse_empty(self):
+        fq = fontqualifiers.FontQualifiers(r'\FHomerton.Medium\ELatin1')
+        fq.parse(r'', allow_empty=True)
+
+        self.assertEqual(fq.fontid, 'Homerton.Medium')
+        self.assertEqual(fq.encoding, 'Latin1')
+
+
 class Test50ApplyFields(FQTestCase):
 
     def test_01_apply_empty(self):